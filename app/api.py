@@ -3,13 +3,31 @@
 # Description: Defines the FastAPI application and its endpoints.
 # --------------------------------------------------------------------------
 import logging
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
+import numpy as np
+import orjson
 from fastapi import FastAPI, HTTPException, BackgroundTasks, Response, status
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import ORJSONResponse, StreamingResponse
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import List, Literal, Optional, Tuple, get_args
 from elasticsearch import ConnectionError
+from langchain_ollama.chat_models import ChatOllama
 
 from app.chains import get_full_chain
-from app.retriever import get_retriever, get_es_client
+from app.config import settings
+from app.retriever import (
+    get_embedding_model,
+    get_es_client,
+    get_retriever,
+    get_sync_es_client,
+    uses_dense_search,
+)
+from app.rrf import warm_rrf_fuse
 from app.ingestion import main as run_ingestion_pipeline
 
 # Configure logging
@@ -19,13 +37,70 @@ app = FastAPI(
     title="RAG Internship API",
     description="An API for the RAG internship project using Elasticsearch and an open LLM.",
     version="1.0.0",
+    default_response_class=ORJSONResponse,
 )
 
+RetrievalMode = Literal["hybrid", "elser_only"]
+RETRIEVAL_MODES = get_args(RetrievalMode)
+
+# --- Cached RAG Components ---
+
+@lru_cache(maxsize=4)
+def _get_cached_retriever(mode: str = "hybrid", k: int = 5):
+    """Builds the retriever for a mode once and reuses it for subsequent queries."""
+    return get_retriever(mode=mode, k=k)
+
+@lru_cache(maxsize=4)
+def _get_cached_chain(mode: str = "hybrid"):
+    """Builds the full RAG chain for a mode once and reuses it for subsequent queries."""
+    return get_full_chain(retriever=_get_cached_retriever(mode))
+
+def _warm_models():
+    """
+    Runs one query embedding and a one-token LLM generation so both models are
+    loaded into memory before the first real query arrives.
+    """
+    start = time.perf_counter()
+    try:
+        _get_cached_retriever("hybrid").embedding_model.embed_query("warmup")
+        llm = ChatOllama(model=settings.llm_model, base_url=settings.ollama_base_url, num_predict=1)
+        llm.invoke("hi")
+        logging.info(f"Model warm-up completed in {time.perf_counter() - start:.2f}s")
+    except Exception as e:
+        logging.warning(f"Model warm-up failed after {time.perf_counter() - start:.2f}s: {e}")
+
+@app.on_event("startup")
+async def warm_rag_components():
+    """
+    Builds the retrievers and chains for all modes so the first query doesn't pay for it,
+    then warms the models (and the RRF kernel, for client-side fusion) in background threads
+    and primes Elasticsearch.
+    """
+    for mode in RETRIEVAL_MODES:
+        _get_cached_chain(mode)
+    logging.info(f"RAG chains ready for modes: {', '.join(RETRIEVAL_MODES)}")
+
+    threading.Thread(target=_warm_models, name="model-warmup", daemon=True).start()
+    if settings.rrf_fusion == "client":
+        threading.Thread(target=warm_rrf_fuse, name="rrf-warmup", daemon=True).start()
+
+    try:
+        await get_es_client().indices.get_mapping(index=settings.index_name)
+    except Exception as e:
+        logging.warning(f"Could not prime Elasticsearch index '{settings.index_name}': {e}")
+
+@app.on_event("shutdown")
+async def close_es_clients():
+    """Closes the shared Elasticsearch clients so their HTTP sessions are released cleanly."""
+    await get_es_client().close()
+    if get_sync_es_client.cache_info().currsize:
+        get_sync_es_client().close()
+
 # --- Pydantic Models for API ---
 
 class QueryRequest(BaseModel):
     question: str
-    retrieval_mode: str = Field(
+    retrieval_mode: RetrievalMode = Field(
         "hybrid", 
         description="Retrieval mode: 'hybrid' or 'elser_only'."
     )
@@ -43,40 +118,138 @@ class HealthResponse(BaseModel):
     api_status: str
     elasticsearch_status: str
 
+# --- Response Cache ---
+# Two tiers, both keyed by (retrieval_mode, normalized question) and evicted together in LRU order:
+# an exact-match lookup, and a semantic lookup over unit-length question embeddings.
+
+CacheKey = Tuple[str, str]
+
+CACHE_LOCK = threading.Lock()
+CACHE_EXACT: "OrderedDict[CacheKey, QueryResponse]" = OrderedDict()
+CACHE_SEM: "OrderedDict[CacheKey, Tuple[np.ndarray, QueryResponse]]" = OrderedDict()
+
+def _normalize_question(question: str) -> str:
+    """Normalizes a question so trivially different phrasings share a cache key."""
+    return " ".join(question.lower().split())
+
+def _embed_question(question: str) -> np.ndarray:
+    """Embeds a question as a unit-length vector so a dot product equals cosine similarity."""
+    vector = np.asarray(get_embedding_model().embed_query(question), dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+def _get_exact_cached_response(key: CacheKey) -> Optional[QueryResponse]:
+    with CACHE_LOCK:
+        cached = CACHE_EXACT.get(key)
+        if cached is not None:
+            CACHE_EXACT.move_to_end(key)
+            if key in CACHE_SEM:
+                CACHE_SEM.move_to_end(key)
+        return cached
+
+def _get_semantic_cached_response(key: CacheKey, vector: np.ndarray) -> Optional[QueryResponse]:
+    with CACHE_LOCK:
+        candidates = [(k, entry) for k, entry in CACHE_SEM.items() if k[0] == key[0]]
+        if not candidates:
+            return None
+        scores = np.dot(np.stack([entry[0] for _, entry in candidates]), vector)
+        best = int(np.argmax(scores))
+        if scores[best] < settings.response_cache_similarity:
+            return None
+        best_key, (_, cached) = candidates[best]
+        CACHE_EXACT.move_to_end(best_key)
+        CACHE_SEM.move_to_end(best_key)
+        return cached
+
+def _store_cached_response(key: CacheKey, vector: Optional[np.ndarray], response: QueryResponse):
+    with CACHE_LOCK:
+        CACHE_EXACT[key] = response
+        CACHE_EXACT.move_to_end(key)
+        if vector is not None:
+            CACHE_SEM[key] = (vector, response)
+            CACHE_SEM.move_to_end(key)
+        while len(CACHE_EXACT) > settings.response_cache_size:
+            evicted_key, _ = CACHE_EXACT.popitem(last=False)
+            CACHE_SEM.pop(evicted_key, None)
+
+def _clear_cached_responses():
+    with CACHE_LOCK:
+        CACHE_EXACT.clear()
+        CACHE_SEM.clear()
+
+# --- Query Helpers ---
+
+async def _lookup_cached_response(request: QueryRequest):
+    """
+    Checks the response cache for a question.
+
+    Returns:
+        A tuple of (cache_key, question_vector, cached_response). The response is None on a miss;
+        the vector is None on an exact-match hit, in ELSER-only mode, and for short queries that the
+        retriever answers with BM25 alone. Those never need a dense embedding, so they only use
+        the exact-match tier.
+    """
+    cache_key = (request.retrieval_mode, _normalize_question(request.question))
+    cached = _get_exact_cached_response(cache_key)
+    if cached is not None:
+        logging.info("Returning exact-match cached response.")
+        return cache_key, None, cached
+    if not uses_dense_search(request.question, request.retrieval_mode):
+        return cache_key, None, None
+
+    # Embed the raw question, exactly as the retriever would, so the chain can reuse this vector
+    question_vector = await run_in_threadpool(_embed_question, request.question)
+    cached = _get_semantic_cached_response(cache_key, question_vector)
+    if cached is not None:
+        logging.info("Returning semantically cached response.")
+    return cache_key, question_vector, cached
+
+def _format_citations(docs) -> List[Citation]:
+    """Builds citations from the documents retrieved as context."""
+    return [
+        Citation(
+            filename=doc.metadata.get("filename", "Unknown"),
+            snippet=doc.page_content,
+            drive_url=doc.metadata.get("drive_url"),
+        )
+        for doc in docs or []
+    ]
+
+def _sse_event(event: str, data) -> str:
+    """Formats a single Server-Sent Event with a JSON payload."""
+    return f"event: {event}\ndata: {orjson.dumps(data).decode()}\n\n"
+
 # --- API Endpoints ---
 
 @app.post("/query", response_model=QueryResponse)
-def query(request: QueryRequest):
+async def query(request: QueryRequest):
     """
     Accepts a user question and returns a grounded answer with citations.
     """
     logging.info(f"Received query: '{request.question}' with mode: '{request.retrieval_mode}'")
     
     try:
-        # 1. Get the appropriate retriever based on the requested mode
-        retriever = get_retriever(mode=request.retrieval_mode)
+        # 1. Serve repeated or near-duplicate questions from the response cache
+        cache_key, question_vector, cached = await _lookup_cached_response(request)
+        if cached is not None:
+            return cached
 
-        # 2. Get the full RAG chain, configured with the chosen retriever
-        chain = get_full_chain(retriever=retriever)
+        # 2. Get the cached RAG chain, configured with the retriever for the chosen mode
+        chain = _get_cached_chain(request.retrieval_mode)
 
         # 3. Invoke the chain with the user's question
         logging.info("Invoking RAG chain...")
-        result = chain.invoke({"question": request.question})
+        result = await chain.ainvoke({"question": request.question, "question_vector": question_vector})
         logging.info("RAG chain invocation complete.")
 
         # 4. Format the citations from the retrieved context
-        citations = []
-        if result.get("context"):
-            for doc in result["context"]:
-                citations.append(
-                    Citation(
-                        filename=doc.metadata.get("filename", "Unknown"),
-                        snippet=doc.page_content,
-                        drive_url=doc.metadata.get("drive_url"),
-                    )
-                )
-
-        return QueryResponse(answer=result["answer"], citations=citations)
+        citations = _format_citations(result.get("context"))
+        response = QueryResponse(answer=result["answer"], citations=citations)
+
+        # 5. Only cache grounded answers, so a failed retrieval isn't replayed to later callers
+        if citations:
+            _store_cached_response(cache_key, question_vector, response)
+
+        return response
 
     except Exception as e:
         # This is the new, more detailed error logging.
@@ -87,6 +260,65 @@ def query(request: QueryRequest):
             detail=f"An internal server error occurred: {str(e)}"
         )
 
+async def _stream_query_events(request: QueryRequest):
+    """
+    Yields the answer as Server-Sent Events: one 'citations' event once retrieval finishes,
+    a 'token' event per generated chunk, then 'done' (or 'error' if generation fails).
+    """
+    try:
+        cache_key, question_vector, cached = await _lookup_cached_response(request)
+        if cached is not None:
+            yield _sse_event("citations", [citation.model_dump() for citation in cached.citations])
+            yield _sse_event("token", cached.answer)
+            yield _sse_event("done", {})
+            return
+
+        chain = _get_cached_chain(request.retrieval_mode)
+        logging.info("Streaming RAG chain...")
+        answer_parts = []
+        citations = []
+        async for chunk in chain.astream({"question": request.question, "question_vector": question_vector}):
+            if "context" in chunk:
+                citations = _format_citations(chunk["context"])
+                yield _sse_event("citations", [citation.model_dump() for citation in citations])
+            if "answer" in chunk:
+                answer_parts.append(chunk["answer"])
+                yield _sse_event("token", chunk["answer"])
+        logging.info("RAG chain streaming complete.")
+
+        if citations:
+            response = QueryResponse(answer="".join(answer_parts), citations=citations)
+            _store_cached_response(cache_key, question_vector, response)
+        yield _sse_event("done", {})
+
+    except Exception as e:
+        # The response status is already sent, so report the failure in-band.
+        logging.error(f"An error occurred during streaming query processing: {e}", exc_info=True)
+        yield _sse_event("error", {"detail": f"An internal server error occurred: {str(e)}"})
+
+@app.post("/query/stream")
+async def query_stream(request: QueryRequest):
+    """
+    Accepts a user question and streams the grounded answer and its citations
+    as Server-Sent Events, so clients can render tokens as they are generated.
+    """
+    logging.info(f"Received streaming query: '{request.question}' with mode: '{request.retrieval_mode}'")
+    return StreamingResponse(_stream_query_events(request), media_type="text/event-stream")
+
+async def _ingest_and_clear_caches():
+    """
+    Runs the ingestion pipeline in the threadpool, then clears the response and retrieval
+    caches so answers and citations from before the re-index aren't served.
+    """
+    try:
+        await run_in_threadpool(run_ingestion_pipeline)
+    finally:
+        # Even a failed ingestion may have re-indexed part of the corpus
+        _clear_cached_responses()
+        for mode in RETRIEVAL_MODES:
+            _get_cached_retriever(mode).clear_cache()
+        logging.info("Cleared response and retrieval caches after ingestion.")
+
 @app.post("/ingest")
 def ingest_documents(background_tasks: BackgroundTasks):
     """
@@ -94,19 +326,19 @@ def ingest_documents(background_tasks: BackgroundTasks):
     to re-index the data in Elasticsearch. This runs as a background task.
     """
     logging.info("Ingestion endpoint triggered.")
-    background_tasks.add_task(run_ingestion_pipeline)
+    background_tasks.add_task(_ingest_and_clear_caches)
     return {"message": "Ingestion process started in the background. Check server logs for progress."}
 
 
 @app.get("/healthz", response_model=HealthResponse)
-def health_check(response: Response):
+async def health_check(response: Response):
     """
     Checks the status of the API and its connection to Elasticsearch.
     """
     es_status = "ok"
     try:
         es_client = get_es_client()
-        if not es_client.ping():
+        if not await es_client.ping():
             raise ConnectionError("Elasticsearch ping failed")
     except ConnectionError as e:
         logging.error(f"Elasticsearch connection health check failed: {e}")
@@ -5,7 +5,7 @@
 from operator import itemgetter
 from langchain_core.output_parsers import StrOutputParser
 from langchain_core.prompts import ChatPromptTemplate
-from langchain_core.runnables import RunnablePassthrough
+from langchain_core.runnables import RunnableLambda, RunnablePassthrough
 from langchain_ollama.chat_models import ChatOllama
 
 from app.retriever import get_retriever
@@ -34,11 +34,17 @@ Do not use any external knowledge or information you were trained on.
 
 def format_docs(docs):
     """Helper function to format retrieved documents into a single string for the prompt."""
-    return "\n\n".join(
-        f"Source Filename: {doc.metadata.get('filename', 'Unknown')}\n"
-        f"Content: {doc.page_content}"
-        for doc in docs
-    )
+    parts = []
+    append = parts.append
+    for doc in docs:
+        append("Source Filename: ")
+        append(doc.metadata.get("filename", "Unknown"))
+        append("\nContent: ")
+        append(doc.page_content)
+        append("\n\n")
+    if parts:
+        parts.pop()  # No separator after the last document
+    return "".join(parts)
 
 def get_full_chain(retriever=None):
     """
@@ -49,7 +55,8 @@ def get_full_chain(retriever=None):
         retriever: An initialized retriever instance. If None, a default one is created.
     
     Returns:
-        A LangChain runnable that returns a dictionary with 'answer' and 'context' keys.
+        A LangChain runnable that takes a 'question' (and optionally a unit-length 'question_vector')
+        and returns a dictionary with 'answer' and 'context' keys.
     """
     if retriever is None:
         # If no retriever is provided, create a default one (hybrid mode).
@@ -58,9 +65,17 @@ def get_full_chain(retriever=None):
     llm = ChatOllama(model=settings.llm_model, base_url=settings.ollama_base_url)
     prompt = ChatPromptTemplate.from_template(PROMPT_TEMPLATE)
 
+    # Retrieves documents for the question, handing the retriever the question's embedding
+    # when the caller already computed one (e.g. for the response cache) so it isn't embedded twice.
+    def retrieve(inputs, config):
+        return retriever.invoke(inputs["question"], config, query_vector=inputs.get("question_vector"))
+
+    async def aretrieve(inputs, config):
+        return await retriever.ainvoke(inputs["question"], config, query_vector=inputs.get("question_vector"))
+
     # This chain takes a question, retrieves documents, and formats them.
     retrieval_and_formatting_chain = (
-        RunnablePassthrough.assign(context=itemgetter("question") | retriever)
+        RunnablePassthrough.assign(context=RunnableLambda(retrieve, afunc=aretrieve))
     )
 
     # This chain generates the answer using the formatted context and question.
@@ -13,6 +13,17 @@ class Settings(BaseSettings):
     elastic_cloud_id: str | None = None
     elastic_api_key: str | None = None
     index_name: str = "rag-internship-demo"
+    index_number_of_replicas: int = 1
+
+    # Retrieval settings
+    rrf_fusion: str = "server" # 'server' (Elasticsearch rank) or 'client' (fused in the API process)
+    knn_num_candidates: int = 50
+    bm25_only_max_terms: int = 2 # Queries with at most this many terms use BM25 only
+    long_query_min_terms: int = 8 # Queries with at least this many terms use fewer kNN candidates
+    long_query_num_candidates: int = 25
+    retriever_cache_size: int = 1024
+    retriever_cache_ttl: int = 300 # Seconds before cached retrieval results expire
+    retriever_cache_similarity: float = 0.97 # Minimum cosine similarity for a semantic cache hit
 
     # Google Drive settings
     google_drive_folder_id: str = "YOUR_GOOGLE_DRIVE_FOLDER_ID"
@@ -20,12 +31,24 @@ class Settings(BaseSettings):
     # Ingestion settings
     chunk_size: int = 300
     chunk_overlap: int = 50
+    embedding_batch_size: int = 128
+    bulk_chunk_size: int = 500
+    bulk_thread_count: int = 4
+    bulk_queue_size: int = 8
+    bulk_request_timeout: int = 120 # Seconds
 
     # Model settings
     embedding_model_name: str = "sentence-transformers/all-MiniLM-L6-v2"
+    use_onnx_embeddings: bool = True # Embed queries with an int8-quantized ONNX Runtime model
+    onnx_model_dir: str = "models/onnx" # Relative to the project root
+    torch_compile_embeddings: bool = True # Compile the HuggingFace embedding model with torch.compile
     llm_model: str = "llama3"
     ollama_base_url: str = "http://localhost:11434" # Ollama server URL
 
+    # Response cache settings
+    response_cache_size: int = 256
+    response_cache_similarity: float = 0.95 # Minimum cosine similarity for a semantic cache hit
+
     class Config:
         env_file = ".env"
         env_file_encoding = "utf-8"
@@ -0,0 +1,141 @@
+# --------------------------------------------------------------------------
+# File: app/embeddings.py
+# Description: Optimized embedding models: a quantized ONNX Runtime embedder for
+#              query-time embedding and a torch.compile'd HuggingFace embedder.
+# --------------------------------------------------------------------------
+import json
+import logging
+import os
+import shutil
+from typing import Any, List, Optional
+
+import numpy as np
+import onnxruntime as ort
+import torch
+from huggingface_hub import hf_hub_download
+from langchain_core.embeddings import Embeddings
+from langchain_huggingface import HuggingFaceEmbeddings
+from optimum.onnxruntime import ORTModelForFeatureExtraction, ORTQuantizer
+from optimum.onnxruntime.configuration import AutoQuantizationConfig
+from pydantic import PrivateAttr
+from transformers import AutoTokenizer
+
+PROJECT_ROOT = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+QUANTIZED_MODEL_FILE = "model_quantized.onnx"
+SENTENCE_BERT_CONFIG_FILE = "sentence_bert_config.json"
+
+
+def export_quantized_model(model_name: str, output_dir: str):
+    """Exports a Hugging Face encoder to ONNX and applies dynamic int8 quantization."""
+    logging.info(f"Exporting {model_name} to ONNX with int8 quantization in {output_dir}")
+    model = ORTModelForFeatureExtraction.from_pretrained(model_name, export=True)
+    quantizer = ORTQuantizer.from_pretrained(model)
+    quantization_config = AutoQuantizationConfig.avx512_vnni(is_static=False, per_channel=False)
+    quantizer.quantize(save_dir=output_dir, quantization_config=quantization_config)
+    AutoTokenizer.from_pretrained(model_name).save_pretrained(output_dir)
+    shutil.copy(hf_hub_download(model_name, SENTENCE_BERT_CONFIG_FILE), output_dir)
+
+
+def load_max_seq_length(model_name: str, model_dir: str) -> Optional[int]:
+    """
+    Reads the sentence-transformers max_seq_length, which can be shorter than the tokenizer's
+    model_max_length (256 vs 512 for all-MiniLM-L6-v2). Returns None if the model has no such config.
+    """
+    config_path = os.path.join(model_dir, SENTENCE_BERT_CONFIG_FILE)
+    try:
+        if not os.path.exists(config_path):
+            config_path = hf_hub_download(model_name, SENTENCE_BERT_CONFIG_FILE)
+        with open(config_path, encoding="utf-8") as f:
+            return json.load(f)["max_seq_length"]
+    except Exception as e:
+        logging.warning(f"No sentence-transformers max_seq_length for {model_name}; using the tokenizer's. Error: {e}")
+        return None
+
+
+class OnnxEmbeddings(Embeddings):
+    """
+    Sentence-transformer embeddings computed with an int8-quantized ONNX Runtime session.
+    Produces mean-pooled, L2-normalized vectors compatible with the indexed embeddings.
+    """
+
+    def __init__(self, model_name: str, cache_dir: str, batch_size: int = 32):
+        model_dir = os.path.join(PROJECT_ROOT, cache_dir, model_name.replace("/", "__"))
+        model_path = os.path.join(model_dir, QUANTIZED_MODEL_FILE)
+        if not os.path.exists(model_path):
+            export_quantized_model(model_name, model_dir)
+
+        self.batch_size = batch_size
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        # Truncate exactly like the sentence-transformers model that embedded the index
+        self.max_length = load_max_seq_length(model_name, model_dir)
+        self.session = ort.InferenceSession(model_path, providers=["CPUExecutionProvider"])
+        self.input_names = {model_input.name for model_input in self.session.get_inputs()}
+
+    def _embed(self, texts: List[str]) -> np.ndarray:
+        encoded = self.tokenizer(
+            texts, padding=True, truncation=True, max_length=self.max_length, return_tensors="np"
+        )
+        inputs = {name: value.astype(np.int64) for name, value in encoded.items() if name in self.input_names}
+        token_embeddings = self.session.run(None, inputs)[0]
+
+        # Mean pooling over non-padding tokens, then L2 normalization
+        mask = encoded["attention_mask"][..., np.newaxis].astype(np.float32)
+        summed = (token_embeddings * mask).sum(axis=1)
+        pooled = summed / np.clip(mask.sum(axis=1), 1e-9, None)
+        return pooled / np.linalg.norm(pooled, axis=1, keepdims=True)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        vectors = [
+            self._embed(texts[i:i + self.batch_size]) for i in range(0, len(texts), self.batch_size)
+        ]
+        return np.concatenate(vectors).tolist() if vectors else []
+
+    def embed_query(self, text: str) -> List[float]:
+        return self._embed([text])[0].tolist()
+
+
+class CompiledHuggingFaceEmbeddings(HuggingFaceEmbeddings):
+    """
+    HuggingFaceEmbeddings whose transformer forward pass is compiled with torch.compile.
+    Compilation is hardware-sensitive and lazy, so a failure at warmup or on any later
+    batch shape falls back to the eager model.
+    """
+
+    _eager_model: Any = PrivateAttr(default=None)
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        transformer = self._client[0]
+        self._eager_model = transformer.auto_model
+        try:
+            transformer.auto_model = torch.compile(self._eager_model, dynamic=True)
+            # torch.compile is lazy; run one batch so most compilation errors surface here
+            self._client.encode(["warmup"])
+            logging.info("Compiled embedding model with torch.compile.")
+        except Exception as e:
+            self._use_eager_model(e)
+
+    def _is_compiled(self) -> bool:
+        return self._client[0].auto_model is not self._eager_model
+
+    def _use_eager_model(self, error: Exception):
+        logging.warning(f"torch.compile failed; using the eager embedding model. Error: {error}")
+        self._client[0].auto_model = self._eager_model
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        try:
+            return super().embed_documents(texts)
+        except Exception as e:
+            if not self._is_compiled():
+                raise
+            self._use_eager_model(e)
+            return super().embed_documents(texts)
+
+    def embed_query(self, text: str) -> List[float]:
+        try:
+            return super().embed_query(text)
+        except Exception as e:
+            if not self._is_compiled():
+                raise
+            self._use_eager_model(e)
+            return super().embed_query(text)
@@ -3,15 +3,24 @@
 # Description: Handles loading, processing, and indexing of documents from a local directory and Google Drive.
 # --------------------------------------------------------------------------
 import logging
+import multiprocessing
 import os
-from elasticsearch import Elasticsearch
-from langchain_community.document_loaders import UnstructuredPDFLoader, PyPDFLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+import re
+import uuid
+import numpy as np
+import torch
+import xxhash
+from concurrent.futures import ProcessPoolExecutor
+from elasticsearch import Elasticsearch, helpers
+from elasticsearch.serializer import OrjsonSerializer
+from langchain_community.document_loaders import UnstructuredPDFLoader
+from langchain_core.documents import Document
 from langchain_huggingface import HuggingFaceEmbeddings
-from langchain_elasticsearch import ElasticsearchStore
 from langchain_google_community import GoogleDriveLoader
 
 from app.config import settings
+from app.embeddings import CompiledHuggingFaceEmbeddings
+from app.pdf_loader import load_one_pdf
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
@@ -21,6 +30,15 @@ LOCAL_DATA_PATH = os.path.join(PROJECT_ROOT, "data")
 CREDENTIALS_PATH = os.path.join(PROJECT_ROOT, "credentials.json")
 TOKEN_PATH = os.path.join(PROJECT_ROOT, "token.json")
 
+# A sentence is a run of text up to and including its terminating punctuation or newlines
+SENTENCE_PATTERN = re.compile(r"[^.!?\n]+[.!?\n]*")
+
+# Index settings used while bulk indexing a new index; restored once ingestion finishes
+BULK_INDEX_SETTINGS = {
+    "refresh_interval": "-1",
+    "number_of_replicas": 0,
+}
+
 
 def get_es_client():
     """Gets an Elasticsearch client instance, handling different auth methods."""
@@ -29,19 +47,21 @@ def get_es_client():
         logging.info("Connecting to Elastic Cloud with Cloud ID.")
         return Elasticsearch(
             cloud_id=settings.elastic_cloud_id,
-            api_key=settings.elastic_api_key
+            api_key=settings.elastic_api_key,
+            serializer=OrjsonSerializer(),
         )
     # Case 2: Connection using URL and API Key
     elif settings.elastic_url and settings.elastic_api_key:
         logging.info(f"Connecting to Elastic URL with API Key: {settings.elastic_url}")
         return Elasticsearch(
             settings.elastic_url,
-            api_key=settings.elastic_api_key
+            api_key=settings.elastic_api_key,
+            serializer=OrjsonSerializer(),
         )
     # Case 3: Connection using only URL (e.g., local, unauthenticated)
     elif settings.elastic_url:
         logging.info(f"Connecting to Elastic URL (no auth): {settings.elastic_url}")
-        return Elasticsearch(settings.elastic_url)
+        return Elasticsearch(settings.elastic_url, serializer=OrjsonSerializer())
     # Error case if no settings are provided
     else:
         raise ValueError("No Elasticsearch connection settings found. Please configure ELASTIC_URL or ELASTIC_CLOUD_ID.")
@@ -51,6 +71,7 @@ def load_docs_from_local_folder():
     """
     Loads PDF documents from a local folder with robust error handling for each file.
     Switched to PyPDFLoader to avoid unstructured dependency issues.
+    Files are parsed in parallel across a process pool, since PDF parsing is CPU-bound.
     """
     if not os.path.exists(LOCAL_DATA_PATH):
         logging.warning(f"Local data directory not found at: {LOCAL_DATA_PATH}. Skipping local ingestion.")
@@ -58,22 +79,25 @@ def load_docs_from_local_folder():
         
     logging.info(f"Loading documents from local directory: {LOCAL_DATA_PATH}")
     
-    loaded_docs = []
-    pdf_files = [f for f in os.listdir(LOCAL_DATA_PATH) if f.endswith('.pdf')]
-
-    for pdf_file in pdf_files:
-        file_path = os.path.join(LOCAL_DATA_PATH, pdf_file)
-        try:
-            # Use PyPDFLoader for more stability and fewer dependencies
-            loader = PyPDFLoader(file_path)
-            docs = loader.load()
-            loaded_docs.extend(docs)
-            logging.info(f"Successfully loaded {pdf_file}")
-        except Exception as e:
-            logging.error(f"Failed to load or process {pdf_file}. Error: {e}", exc_info=True)
-            # Continue to the next file
-            continue
-            
+    pdf_paths = [
+        os.path.join(LOCAL_DATA_PATH, f) for f in os.listdir(LOCAL_DATA_PATH) if f.endswith('.pdf')
+    ]
+    if not pdf_paths:
+        logging.info("No PDF files found in the local folder.")
+        return []
+
+    # Forking is unsafe here: /ingest runs this inside the multi-threaded API process.
+    # The fork server preloads only the lightweight PDF loader module (not __main__), so
+    # workers don't import the torch/ONNX stacks just to run pypdf.
+    mp_context = multiprocessing.get_context("forkserver")
+    mp_context.set_forkserver_preload(["app.pdf_loader"])
+    with ProcessPoolExecutor(
+        max_workers=min(len(pdf_paths), os.cpu_count() or 1),
+        mp_context=mp_context,
+    ) as executor:
+        results = list(executor.map(load_one_pdf, pdf_paths))
+
+    loaded_docs = [doc for docs in results for doc in docs]
     logging.info(f"Loaded a total of {len(loaded_docs)} documents from the local folder.")
     return loaded_docs
 
@@ -103,15 +127,74 @@ def load_docs_from_gdrive():
         return []
 
 
+def fast_split(text, size, overlap):
+    """
+    Splits text into chunks of at most `size` characters on sentence boundaries.
+    Each chunk starts with up to `overlap` characters of trailing sentences from the previous one.
+    Sentences longer than `size` are split into fixed-size character windows.
+    """
+    spans = np.array([match.span() for match in SENTENCE_PATTERN.finditer(text)], dtype=np.int64)
+    if not len(spans):
+        return []
+    starts, ends = spans[:, 0], spans[:, 1]
+    num_sentences = len(starts)
+
+    chunks = []
+    i = 0
+    while i < num_sentences:
+        # The last sentence that still fits in a chunk starting at sentence i
+        j = int(np.searchsorted(ends, starts[i] + size, side="right")) - 1
+        if j < i:
+            start, end = int(starts[i]), int(ends[i])
+            step = max(size - overlap, 1)
+            chunks.extend(text[offset:min(offset + size, end)] for offset in range(start, end - overlap, step))
+            i += 1
+            continue
+
+        chunks.append(text[starts[i]:ends[j]])
+        if j == num_sentences - 1:
+            break
+
+        # Begin the next chunk at the earliest sentence within `overlap` characters of this chunk's
+        # end, unless carrying those sentences over leaves no room for the next new sentence.
+        next_i = int(np.searchsorted(starts, ends[j] - overlap, side="left"))
+        if ends[j + 1] - starts[next_i] > size:
+            next_i = j + 1
+        i = max(next_i, i + 1)
+
+    return [chunk.strip() for chunk in chunks if chunk.strip()]
+
+
+def deduplicate_chunks(chunks):
+    """
+    Drops chunks whose text repeats an earlier chunk (e.g. repeated headers and footers,
+    or the same file uploaded twice), ignoring case and whitespace differences.
+    """
+    seen = set()
+    unique_chunks = []
+    for chunk in chunks:
+        key = xxhash.xxh64(" ".join(chunk.page_content.lower().split())).intdigest()
+        if key in seen:
+            continue
+        seen.add(key)
+        unique_chunks.append(chunk)
+
+    if chunks:
+        removed = len(chunks) - len(unique_chunks)
+        logging.info(f"Removed {removed} duplicate chunks ({removed / len(chunks):.1%}); {len(unique_chunks)} remain.")
+    return unique_chunks
+
+
 def chunk_documents(docs):
     """Splits documents into smaller chunks."""
-    text_splitter = RecursiveCharacterTextSplitter(
-        chunk_size=settings.chunk_size,
-        chunk_overlap=settings.chunk_overlap,
-        length_function=len,
-    )
-    chunks = text_splitter.split_documents(docs)
+    chunks = [
+        Document(page_content=text, metadata=dict(doc.metadata))
+        for doc in docs
+        for text in fast_split(doc.page_content, settings.chunk_size, settings.chunk_overlap)
+    ]
     logging.info(f"Split {len(docs)} documents into {len(chunks)} chunks.")
+
+    chunks = deduplicate_chunks(chunks)
     
     # Add chunk_id and standardize metadata for both sources
     for i, chunk in enumerate(chunks):
@@ -124,11 +207,36 @@ def chunk_documents(docs):
 
     return chunks
 
+def get_embedding_model():
+    """
+    Creates the embedding model used for bulk ingestion.
+    Encodes in large batches, on the GPU in FP16 when one is available, with the
+    transformer compiled by torch.compile unless disabled in settings.
+    """
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    model_kwargs = {"device": device}
+    if device == "cuda":
+        model_kwargs["model_kwargs"] = {"torch_dtype": torch.float16}
+    logging.info(f"Loading embedding model on {device}: {settings.embedding_model_name}")
+
+    embeddings_cls = CompiledHuggingFaceEmbeddings if settings.torch_compile_embeddings else HuggingFaceEmbeddings
+    return embeddings_cls(
+        model_name=settings.embedding_model_name,
+        model_kwargs=model_kwargs,
+        encode_kwargs={
+            "batch_size": settings.embedding_batch_size,
+            "normalize_embeddings": True,
+        },
+    )
+
 def create_index_if_not_exists(client, index_name):
-    """Creates an Elasticsearch index with specific mappings if it doesn't exist."""
+    """
+    Creates an Elasticsearch index with specific mappings if it doesn't exist.
+    Returns True if the index was created (with bulk indexing settings), False if it already existed.
+    """
     if client.indices.exists(index=index_name):
         logging.info(f"Index '{index_name}' already exists. Skipping creation.")
-        return
+        return False
 
     logging.info(f"Creating index '{index_name}' with custom mappings.")
     
@@ -140,7 +248,13 @@ def create_index_if_not_exists(client, index_name):
                 "type": "dense_vector",
                 "dims": 384,  # Corresponds to all-MiniLM-L6-v2
                 "index": True,
-                "similarity": "cosine"
+                "similarity": "dot_product",  # Vectors are L2-normalized before indexing
+                # int8 scalar quantization keeps the HNSW graph ~4x smaller in memory
+                "index_options": {
+                    "type": "int8_hnsw",
+                    "m": 16,
+                    "ef_construction": 100
+                }
             },
             "text_expansion": {
                 "type": "rank_features" 
@@ -157,10 +271,63 @@ def create_index_if_not_exists(client, index_name):
         }
     }
     
-    client.indices.create(index=index_name, mappings=mappings)
+    client.indices.create(index=index_name, mappings=mappings, settings=BULK_INDEX_SETTINGS)
     logging.info("Index created successfully.")
+    return True
 
 
+def restore_index_settings(client, index_name):
+    """
+    Re-enables periodic refresh and replicas once bulk indexing into a new index is done.
+    Failures are logged rather than raised, so they don't mask an earlier indexing error.
+    """
+    try:
+        client.indices.put_settings(
+            index=index_name,
+            settings={
+                "refresh_interval": None,  # Reset to the cluster default
+                "number_of_replicas": settings.index_number_of_replicas,
+            },
+        )
+        logging.info(f"Restored refresh interval and replicas on index '{index_name}'.")
+    except Exception as e:
+        logging.error(f"Failed to restore settings on index '{index_name}'. Error: {e}", exc_info=True)
+
+
+def index_chunks(client, index_name, chunks, vectors):
+    """Bulk-indexes chunks and their pre-computed vectors using parallel bulk worker threads."""
+    actions = (
+        {
+            "_index": index_name,
+            "_id": str(uuid.uuid4()),
+            "_source": {
+                "text": chunk.page_content,
+                "vector": vector.tolist(),
+                "metadata": chunk.metadata,
+            },
+        }
+        for chunk, vector in zip(chunks, vectors)
+    )
+
+    indexed, failed = 0, 0
+    for ok, info in helpers.parallel_bulk(
+        client,
+        actions,
+        thread_count=settings.bulk_thread_count,
+        chunk_size=settings.bulk_chunk_size,
+        queue_size=settings.bulk_queue_size,
+        raise_on_error=False,
+    ):
+        if ok:
+            indexed += 1
+        else:
+            failed += 1
+            logging.error(f"Failed to index chunk: {info}")
+
+    logging.info(f"Indexed {indexed} chunks ({failed} failed).")
+    if failed:
+        raise RuntimeError(f"{failed} chunks failed to index into '{index_name}'.")
+
 def main():
     """Main ingestion pipeline."""
     logging.info("Starting ingestion process...")
@@ -179,25 +346,34 @@ def main():
     # 2. Chunk documents
     chunks = chunk_documents(all_docs)
 
-    # 3. Initialize embedding model
-    embeddings = HuggingFaceEmbeddings(model_name=settings.embedding_model_name)
+    if not chunks:
+        # e.g. scanned PDFs, which PyPDFLoader loads without any text
+        logging.warning("Documents produced no text chunks. Exiting ingestion.")
+        return
+
+    # 3. Initialize embedding model and embed all chunks in large batches.
+    # The model L2-normalizes its output, so the index can score with dot_product.
+    embeddings = get_embedding_model()
+    texts = [chunk.page_content for chunk in chunks]
+    logging.info(f"Embedding {len(texts)} chunks...")
+    vectors = np.asarray(embeddings.embed_documents(texts), dtype=np.float32)
 
     # 4. Get ES client and create index with mapping
     logging.info("Connecting to Elasticsearch...")
-    es_client = get_es_client()
-    create_index_if_not_exists(es_client, settings.index_name)
+    es_client = get_es_client().options(request_timeout=settings.bulk_request_timeout)
+    index_created = create_index_if_not_exists(es_client, settings.index_name)
     
     # 5. Index into Elasticsearch
     logging.info(f"Indexing chunks into Elasticsearch index: {settings.index_name}")
 
-    db = ElasticsearchStore.from_documents(
-        chunks,
-        embeddings,
-        es_connection=es_client,
-        index_name=settings.index_name,
-        # The strategy is no longer needed here as the index and mappings are pre-defined
-    )
-    db.client.indices.refresh(index=settings.index_name)
+    try:
+        # Index the pre-computed vectors so the chunks aren't tokenized and embedded a second time
+        index_chunks(es_client, settings.index_name, chunks, vectors)
+        es_client.indices.refresh(index=settings.index_name)
+    finally:
+        # Only a newly created index carries the bulk settings; an existing index keeps its own
+        if index_created:
+            restore_index_settings(es_client, settings.index_name)
     logging.info("Ingestion process completed successfully.")
 
 if __name__ == "__main__":
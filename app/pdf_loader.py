@@ -0,0 +1,23 @@
+# --------------------------------------------------------------------------
+# File: app/pdf_loader.py
+# Description: Single-PDF loader run in ingestion worker processes. Kept free of the
+#              ML and Elasticsearch imports so workers start quickly.
+# --------------------------------------------------------------------------
+import logging
+import os
+
+from langchain_community.document_loaders import PyPDFLoader
+
+logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+
+def load_one_pdf(file_path):
+    """Loads a single PDF, returning an empty list if it can't be parsed."""
+    try:
+        # Use PyPDFLoader for more stability and fewer dependencies
+        docs = PyPDFLoader(file_path).load()
+        logging.info(f"Successfully loaded {os.path.basename(file_path)}")
+        return docs
+    except Exception as e:
+        logging.error(f"Failed to load or process {os.path.basename(file_path)}. Error: {e}", exc_info=True)
+        return []
@@ -2,128 +2,377 @@
 # File: app/retriever.py
 # Description: Defines the hybrid retriever logic for Elasticsearch.
 # --------------------------------------------------------------------------
+import asyncio
+import hashlib
 import logging
-from typing import List
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Awaitable, Callable, List, Optional, Tuple
 
-from langchain_core.callbacks import CallbackManagerForRetrieverRun
+import numpy as np
+from langchain_core.callbacks import (
+    AsyncCallbackManagerForRetrieverRun,
+    CallbackManagerForRetrieverRun,
+)
 from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
 from langchain_core.retrievers import BaseRetriever
 from langchain_huggingface import HuggingFaceEmbeddings
-from elasticsearch import Elasticsearch
+from elasticsearch import AsyncElasticsearch, Elasticsearch
+from elasticsearch.serializer import OrjsonSerializer
+from pydantic import PrivateAttr
 
 from app.config import settings
+from app.embeddings import CompiledHuggingFaceEmbeddings, OnnxEmbeddings
+from app.rrf import rrf_fuse
 
 # Configure logging
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 
-def get_es_client():
-    """Gets an Elasticsearch client instance."""
+def _es_client_kwargs():
+    """Builds the connection arguments shared by the async and sync Elasticsearch clients."""
     if settings.elastic_cloud_id:
         logging.info(f"Connecting to Elastic Cloud: {settings.elastic_cloud_id}")
-        return Elasticsearch(
-            cloud_id=settings.elastic_cloud_id,
-            api_key=settings.elastic_api_key
-        )
+        return {
+            "cloud_id": settings.elastic_cloud_id,
+            "api_key": settings.elastic_api_key,
+            "serializer": OrjsonSerializer(),
+        }
     elif settings.elastic_url and settings.elastic_api_key:
         logging.info(f"Connecting to Elastic URL with API Key: {settings.elastic_url}")
-        return Elasticsearch(
-            hosts=[settings.elastic_url],
-            api_key=settings.elastic_api_key
-        )
+        return {
+            "hosts": [settings.elastic_url],
+            "api_key": settings.elastic_api_key,
+            "serializer": OrjsonSerializer(),
+        }
     logging.info(f"Connecting to Elastic URL (unauthenticated): {settings.elastic_url}")
-    return Elasticsearch(hosts=[settings.elastic_url])
+    return {"hosts": [settings.elastic_url], "serializer": OrjsonSerializer()}
+
+@lru_cache(maxsize=1)
+def get_es_client():
+    """
+    Gets a shared async Elasticsearch client instance (created once per process).
+    Ingestion uses its own synchronous client.
+    """
+    return AsyncElasticsearch(**_es_client_kwargs())
+
+@lru_cache(maxsize=1)
+def get_sync_es_client():
+    """
+    Gets a shared synchronous Elasticsearch client, used only when the retriever is called
+    through the sync invoke() API. The async client is bound to the API's event loop.
+    """
+    return Elasticsearch(**_es_client_kwargs())
+
+@lru_cache(maxsize=1)
+def get_embedding_model():
+    """
+    Loads the dense query embedding model once and reuses it across retrievers.
+    Uses the int8-quantized ONNX Runtime model unless disabled in settings.
+    """
+    if settings.use_onnx_embeddings:
+        logging.info(f"Loading quantized ONNX embedding model: {settings.embedding_model_name}")
+        return OnnxEmbeddings(
+            model_name=settings.embedding_model_name,
+            cache_dir=settings.onnx_model_dir,
+        )
+    logging.info(f"Loading embedding model: {settings.embedding_model_name}")
+    if settings.torch_compile_embeddings:
+        return CompiledHuggingFaceEmbeddings(model_name=settings.embedding_model_name)
+    return HuggingFaceEmbeddings(model_name=settings.embedding_model_name)
+
+# Reciprocal Rank Fusion (RRF) parameters, shared by server- and client-side fusion
+RRF_RANK_CONSTANT = 20
+RRF_RANK_WINDOW_SIZE = 100
+
+# Options shared by every search: return only the fields needed to build Documents, never the
+# large vector or ELSER expansion fields, and skip counting total hits. Field names follow the
+# index mapping in app/ingestion.py: text, vector, text_expansion and metadata.
+SEARCH_OPTIONS = {
+    "source_includes": ["text", "metadata"],
+    "source_excludes": ["vector", "text_expansion"],
+    "track_total_hits": False,
+}
+
+
+def uses_dense_search(query: str, mode: str = "hybrid") -> bool:
+    """
+    Whether retrieving `query` in `mode` runs a dense kNN search and so needs its embedding.
+    One- or two-term keyword queries are dominated by BM25 and skip the dense search.
+    """
+    return mode != "elser_only" and len(query.split()) > settings.bm25_only_max_terms
 
 class HybridRetriever(BaseRetriever):
     """
     Custom retriever that combines dense, sparse (ELSER), and keyword (BM25) search
     using Reciprocal Rank Fusion (RRF) for ranking.
+
+    `client` serves async calls (ainvoke). Sync calls (invoke) use `sync_client`, which
+    defaults to the shared client from get_sync_es_client(); pass one explicitly when `client`
+    points at a different cluster.
     """
-    client: Elasticsearch
+    client: AsyncElasticsearch
+    sync_client: Optional[Elasticsearch] = None
     index_name: str
-    embedding_model: HuggingFaceEmbeddings
+    embedding_model: Optional[Embeddings] = None # Not needed in 'elser_only' mode
     k: int = 5
     mode: str = "hybrid"
 
+    # Retrieved documents by query hash: (stored_at, unit query vector or None, documents).
+    # Guarded by a lock because sync invoke() calls run retrieval on other threads.
+    _doc_cache: "OrderedDict[str, Tuple[float, Optional[np.ndarray], List[Document]]]" = PrivateAttr(
+        default_factory=OrderedDict
+    )
+    _cache_lock: threading.Lock = PrivateAttr(default_factory=threading.Lock)
+
+    @staticmethod
+    def _cache_key(query: str) -> str:
+        return hashlib.blake2b(query.encode(), digest_size=16).hexdigest()
+
+    @staticmethod
+    def _copy_documents(docs: List[Document]) -> List[Document]:
+        """Copies cached documents so callers can't mutate the cached entries."""
+        return [Document(page_content=doc.page_content, metadata=dict(doc.metadata)) for doc in docs]
+
+    def _evict_expired_documents(self):
+        expires_before = time.monotonic() - settings.retriever_cache_ttl
+        while self._doc_cache:
+            key, (stored_at, _, _) = next(iter(self._doc_cache.items()))
+            if stored_at >= expires_before:
+                break
+            del self._doc_cache[key]
+
+    def _get_cached_documents(self, key: str) -> Optional[List[Document]]:
+        with self._cache_lock:
+            self._evict_expired_documents()
+            entry = self._doc_cache.get(key)
+            if entry is None:
+                return None
+            return self._copy_documents(entry[2])
+
+    def _get_semantically_cached_documents(self, query_vector: np.ndarray) -> Optional[List[Document]]:
+        """Returns the documents of the most similar cached query, if it is close enough."""
+        with self._cache_lock:
+            entries = [entry for entry in self._doc_cache.values() if entry[1] is not None]
+        if not entries:
+            return None
+        scores = np.dot(np.stack([entry[1] for entry in entries]), query_vector)
+        best = int(np.argmax(scores))
+        if scores[best] < settings.retriever_cache_similarity:
+            return None
+        return self._copy_documents(entries[best][2])
+
+    def _store_cached_documents(self, key: str, query_vector: Optional[np.ndarray], docs: List[Document]):
+        # Entries are kept in insertion order, so the oldest entry is always evicted first
+        with self._cache_lock:
+            self._doc_cache.pop(key, None)
+            self._doc_cache[key] = (time.monotonic(), query_vector, self._copy_documents(docs))
+            while len(self._doc_cache) > settings.retriever_cache_size:
+                self._doc_cache.popitem(last=False)
+
+    def clear_cache(self):
+        """Drops all cached retrieval results, e.g. after the index has been re-ingested."""
+        with self._cache_lock:
+            self._doc_cache.clear()
+
     def _get_relevant_documents(
-        self, query: str, *, run_manager: CallbackManagerForRetrieverRun
+        self,
+        query: str,
+        *,
+        run_manager: CallbackManagerForRetrieverRun,
+        query_vector: Optional[np.ndarray] = None,
     ) -> List[Document]:
         """
-        Executes the hybrid retrieval logic.
+        Sync entry point: runs the same retrieval logic on a private event loop against
+        the synchronous client. Must not be called from a thread with a running event loop.
+        """
+        sync_client = self.sync_client or get_sync_es_client()
+
+        async def search(**kwargs):
+            return sync_client.search(**kwargs)
+
+        return asyncio.run(self._retrieve(query, search, query_vector))
+
+    async def _aget_relevant_documents(
+        self,
+        query: str,
+        *,
+        run_manager: AsyncCallbackManagerForRetrieverRun,
+        query_vector: Optional[np.ndarray] = None,
+    ) -> List[Document]:
+        return await self._retrieve(query, self.client.search, query_vector)
+
+    async def _retrieve(
+        self, query: str, search: Callable[..., Awaitable[dict]], query_vector: Optional[np.ndarray]
+    ) -> List[Document]:
+        """
+        Executes the hybrid retrieval logic, issuing searches through the given `search` coroutine.
+        A unit-length query_vector computed by the caller is reused instead of embedding the query again.
         """
         logging.info(f"Executing retrieval with mode: '{self.mode}'")
+
+        cache_key = self._cache_key(query)
+        cached_docs = self._get_cached_documents(cache_key)
+        if cached_docs is not None:
+            logging.info("Returning cached retrieval results.")
+            return cached_docs
         
         # ELSER Sparse Vector Search query
         elser_query = {
             "text_expansion": {
-                "elser_embedding_field": {
+                "text_expansion": {
                     "model_id": "elser",
                     "model_text": query,
                 }
             }
         }
+
+        # BM25 Keyword Search query
+        bm25_query = {"match": {"text": {"query": query}}}
+
+        # Adapt the amount of search work to the query: one- or two-term keyword queries are
+        # dominated by BM25, and long natural-language queries need fewer kNN candidates.
+        num_terms = len(query.split())
         
         try:
             if self.mode == "elser_only":
                 # Execute ELSER-only search
-                response = self.client.search(
+                response = await search(
                     index=self.index_name,
                     query=elser_query,
-                    size=self.k
+                    size=self.k,
+                    **SEARCH_OPTIONS,
                 )
+                hits = response["hits"]["hits"]
+            elif not uses_dense_search(query, self.mode):
+                # Execute BM25-only search, skipping the dense embedding and ELSER inference
+                logging.info(f"Short query ({num_terms} terms); using BM25 only.")
+                response = await search(
+                    index=self.index_name,
+                    query=bm25_query,
+                    size=self.k,
+                    **SEARCH_OPTIONS,
+                )
+                hits = response["hits"]["hits"]
             else:
                 # Execute Hybrid Search
-                # Dense Vector Search (HNSW) parameters
+                # Dense Vector Search (HNSW) parameters.
+                # The index scores with dot_product, so the query vector must be unit length.
+                if query_vector is None:
+                    query_vector = np.asarray(await self.embedding_model.aembed_query(query), dtype=np.float32)
+                    query_vector /= np.linalg.norm(query_vector)
+
+                # Reuse the results of a near-identical earlier query before searching
+                cached_docs = self._get_semantically_cached_documents(query_vector)
+                if cached_docs is not None:
+                    logging.info("Returning semantically cached retrieval results.")
+                    return cached_docs
+
                 knn_query = {
-                    "field": "vector_field",
-                    "query_vector": self.embedding_model.embed_query(query),
+                    "field": "vector",
+                    "query_vector": query_vector.tolist(),
                     "k": self.k,
-                    "num_candidates": 50,
+                    "num_candidates": (
+                        settings.long_query_num_candidates
+                        if num_terms >= settings.long_query_min_terms
+                        else settings.knn_num_candidates
+                    ),
                 }
 
-                # BM25 Keyword Search query
-                bm25_query = {"match": {"text_content": {"query": query}}}
-
-                # RRF Rank configuration
-                rank_config = {"rrf": {"rank_constant": 20, "window_size": 100}}
+                if settings.rrf_fusion == "client":
+                    hits = await self._search_with_client_side_rrf(search, knn_query, [bm25_query, elser_query])
+                else:
+                    # Fuse the three rankers server-side with an RRF retriever in a single request
+                    rrf_retriever = {
+                        "rrf": {
+                            "retrievers": [
+                                {"standard": {"query": bm25_query}},
+                                {"standard": {"query": elser_query}},
+                                {"knn": knn_query},
+                            ],
+                            "rank_constant": RRF_RANK_CONSTANT,
+                            "rank_window_size": RRF_RANK_WINDOW_SIZE,
+                        }
+                    }
 
-                # Pass search components as keyword arguments instead of a single 'body' dict.
-                # This is a more robust way to build the query.
-                response = self.client.search(
-                    index=self.index_name,
-                    knn=knn_query,
-                    sub_searches=[
-                        {"query": bm25_query},
-                        {"query": elser_query},
-                    ],
-                    rank=rank_config,
-                    size=self.k,
-                )
+                    # Pass search components as keyword arguments instead of a single 'body' dict.
+                    # This is a more robust way to build the query.
+                    response = await search(
+                        index=self.index_name,
+                        retriever=rrf_retriever,
+                        size=self.k,
+                        **SEARCH_OPTIONS,
+                    )
+                    hits = response["hits"]["hits"]
             
             docs = []
-            for hit in response["hits"]["hits"]:
+            for hit in hits:
                 docs.append(
                     Document(
-                        page_content=hit["_source"]["text_content"],
+                        page_content=hit["_source"]["text"],
                         metadata=hit["_source"]["metadata"],
                     )
                 )
+            # Empty results are not cached, so documents indexed later are found straight away
+            if docs:
+                self._store_cached_documents(cache_key, query_vector, docs)
             return docs
 
         except Exception as e:
             logging.error(f"Error during Elasticsearch retrieval: {e}", exc_info=True)
             return []
 
+    async def _search_with_client_side_rrf(
+        self, search: Callable[..., Awaitable[dict]], knn_query: dict, queries: List[dict]
+    ) -> List[dict]:
+        """
+        Runs the kNN search and each query as concurrent searches and fuses their rankings
+        locally with RRF, for clusters whose license doesn't include server-side RRF.
+        """
+        window_knn_query = {
+            **knn_query,
+            "k": RRF_RANK_WINDOW_SIZE,
+            "num_candidates": max(knn_query["num_candidates"], RRF_RANK_WINDOW_SIZE),
+        }
+        search_kwargs = {"index": self.index_name, "size": RRF_RANK_WINDOW_SIZE, **SEARCH_OPTIONS}
+        searches = [search(knn=window_knn_query, **search_kwargs)]
+        searches += [search(query=query, **search_kwargs) for query in queries]
+        responses = await asyncio.gather(*searches)
+
+        # Collect each search's ranked hit IDs, keeping the first copy of every hit
+        hits_by_id = {}
+        ranked_ids = []
+        for response in responses:
+            ids = []
+            for hit in response["hits"]["hits"]:
+                hits_by_id.setdefault(hit["_id"], hit)
+                ids.append(hit["_id"])
+            ranked_ids.append(ids)
+        if not hits_by_id:
+            return []
+
+        doc_ids = list(hits_by_id)
+        positions = {doc_id: i for i, doc_id in enumerate(doc_ids)}
+        ranks = np.zeros((len(ranked_ids), len(doc_ids)), dtype=np.int64)
+        for i, ids in enumerate(ranked_ids):
+            for rank, doc_id in enumerate(ids, start=1):
+                ranks[i, positions[doc_id]] = rank
+
+        order = rrf_fuse(ranks, RRF_RANK_CONSTANT)
+        return [hits_by_id[doc_ids[j]] for j in order[:self.k]]
+
 def get_retriever(mode: str = "hybrid", k: int = 5):
     """
     Factory function to create an instance of the HybridRetriever.
+    The Elasticsearch client and embedding model are shared singletons, and the
+    embedding model is only loaded for modes that run a dense vector search.
     """
-    es_client = get_es_client()
-    embedding_model = HuggingFaceEmbeddings(model_name=settings.embedding_model_name)
-    
     return HybridRetriever(
-        client=es_client,
+        client=get_es_client(),
         index_name=settings.index_name,
-        embedding_model=embedding_model,
+        embedding_model=None if mode == "elser_only" else get_embedding_model(),
         k=k,
         mode=mode,
     )
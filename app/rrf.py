@@ -0,0 +1,37 @@
+# --------------------------------------------------------------------------
+# File: app/rrf.py
+# Description: JIT-compiled Reciprocal Rank Fusion (RRF) for client-side hybrid ranking.
+# --------------------------------------------------------------------------
+import logging
+
+import numpy as np
+from numba import njit
+
+
+@njit(cache=True)
+def rrf_fuse(rank_arrays: np.ndarray, k_rank_constant: int) -> np.ndarray:
+    """
+    Fuses several rankings of the same candidate documents with RRF.
+
+    Args:
+        rank_arrays: (n_searches, n_docs) array of 1-based ranks, with 0 where a search
+            did not return the document.
+        k_rank_constant: RRF rank constant; higher values flatten the contribution of top ranks.
+
+    Returns:
+        Document indices sorted by descending fused score.
+    """
+    n_searches, n_docs = rank_arrays.shape
+    scores = np.zeros(n_docs, dtype=np.float64)
+    for i in range(n_searches):
+        for j in range(n_docs):
+            rank = rank_arrays[i, j]
+            if rank > 0:
+                scores[j] += 1.0 / (k_rank_constant + rank)
+    return np.argsort(-scores, kind="mergesort")
+
+
+def warm_rrf_fuse():
+    """Compiles rrf_fuse (or loads it from the on-disk cache) ahead of the first query."""
+    rrf_fuse(np.ones((3, 2), dtype=np.int64), 20)
+    logging.info("RRF fusion kernel compiled.")
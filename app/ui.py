@@ -2,11 +2,27 @@
 # File: app/ui.py
 # Description: A simple Streamlit web interface for the RAG system.
 # --------------------------------------------------------------------------
+import json
+
 import streamlit as st
 import requests
+from requests.adapters import HTTPAdapter
 
 # --- Configuration ---
-API_URL = "http://127.0.0.1:8000/query"
+API_URL = "http://127.0.0.1:8000/query/stream"
+
+@st.cache_resource
+def get_http_session():
+    """
+    Returns a pooled keep-alive HTTP session for talking to the API.
+    Cached as a Streamlit resource so it survives script reruns instead of reconnecting each turn.
+    """
+    session = requests.Session()
+    session.headers.update({"Connection": "keep-alive"})
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
 
 # --- Streamlit Page Setup ---
 st.set_page_config(page_title="RAG Internship Project", layout="wide")
@@ -29,10 +45,28 @@ with st.sidebar:
 # Map UI selection to API parameter
 mode_map = {
     "Hybrid (ELSER + Dense + BM25)": "hybrid",
-    "ELSER-only": "elser"
+    "ELSER-only": "elser_only"
 }
 selected_mode = mode_map[retrieval_mode]
 
+def stream_answer(response, citations):
+    """
+    Yields answer tokens from the API's Server-Sent Events stream.
+    Citations received along the way are appended to the given list.
+    """
+    event = None
+    for line in response.iter_lines(decode_unicode=True):
+        if line.startswith("event: "):
+            event = line[len("event: "):]
+        elif line.startswith("data: "):
+            data = json.loads(line[len("data: "):])
+            if event == "token":
+                yield data
+            elif event == "citations":
+                citations.extend(data)
+            elif event == "error":
+                raise RuntimeError(data.get("detail", "Unknown error"))
+
 # Main chat interface
 if "messages" not in st.session_state:
     st.session_state.messages = []
@@ -47,32 +81,29 @@ if prompt := st.chat_input("Ask a question about your documents..."):
         st.markdown(prompt)
 
     with st.chat_message("assistant"):
-        message_placeholder = st.empty()
-        with st.spinner("Thinking..."):
-            try:
-                # --- Call FastAPI Backend ---
-                payload = {"question": prompt, "mode": selected_mode}
-                response = requests.post(API_URL, json=payload, timeout=120)
+        answer = "Sorry, something went wrong."
+        try:
+            # --- Call FastAPI Backend and stream the answer as it is generated ---
+            payload = {"question": prompt, "retrieval_mode": selected_mode}
+            citations = []
+            with st.spinner("Thinking..."):
+                response = get_http_session().post(API_URL, json=payload, stream=True, timeout=120)
                 response.raise_for_status() # Raise an exception for bad status codes
-                
-                result = response.json()
-                answer = result.get("answer", "Sorry, something went wrong.")
-                sources = result.get("sources", [])
-                
-                # --- Display Answer and Sources ---
-                message_placeholder.markdown(answer)
-                
-                if sources:
-                    st.subheader("Sources:")
-                    for source in sources:
-                        with st.expander(f"Source: {source['metadata'].get('filename', 'Unknown')}"):
-                            st.text(f"Relevance Score: {source['metadata'].get('_score', 'N/A')}")
-                            st.markdown(source['page_content'])
-                            
-            except requests.exceptions.RequestException as e:
-                st.error(f"Failed to connect to the API. Is it running? Error: {e}")
-            except Exception as e:
-                st.error(f"An error occurred: {e}")
-                
+            answer = st.write_stream(stream_answer(response, citations))
+
+            # --- Display Sources ---
+            if citations:
+                st.subheader("Sources:")
+                for citation in citations:
+                    with st.expander(f"Source: {citation.get('filename', 'Unknown')}"):
+                        if citation.get("drive_url"):
+                            st.markdown(f"[Open in Google Drive]({citation['drive_url']})")
+                        st.markdown(citation["snippet"])
+
+        except requests.exceptions.RequestException as e:
+            st.error(f"Failed to connect to the API. Is it running? Error: {e}")
+        except Exception as e:
+            st.error(f"An error occurred: {e}")
+
         full_response = answer
         st.session_state.messages.append({"role": "assistant", "content": full_response})